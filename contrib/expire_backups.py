@@ -12,8 +12,9 @@ import os
 import re
 import textwrap
 import shutil
-from datetime import datetime, timedelta
+from datetime import datetime
 from collections import defaultdict
+from bisect import bisect_left, insort
 
 # We are running from the S3QL source directory, make sure
 # that we use modules from this directory
@@ -29,6 +30,13 @@ from s3ql.remove import main as s3qlrm
 
 log = logging.getLogger(__name__)
 
+# Names of backup directories (YYYY-MM-DD_HH:mm:SS)
+BACKUP_RE = re.compile(r'^\d{4}-\d\d-\d\d_\d\d:\d\d:\d\d$')
+
+# Key in the state file under which the age ranges of the last run are
+# stored (this can never clash with a backup name)
+CYCLES_KEY = 'cycles'
+
 def parse_args(args):
     '''Parse command line'''
 
@@ -92,8 +100,9 @@ def main(args=None):
     setup_logging(options)
 
     # Determine available backups
-    backup_list = set(x for x in os.listdir('.')
-                      if re.match(r'^\d{4}-\d\d-\d\d_\d\d:\d\d:\d\d$', x))
+    with os.scandir('.') as it:
+        backup_list = set(e.name for e in it if BACKUP_RE.match(e.name)
+                          and e.is_dir(follow_symlinks=False))
 
     if not os.path.exists(options.state) and len(backup_list) > 1:
         if not options.reconstruct_state:
@@ -113,7 +122,11 @@ def main(args=None):
         with open(options.state, 'rb') as fh:
             state = thaw_basic_mapping(fh.read())
 
-    to_delete = process_backups(backup_list, state, options.cycles)
+    last_cycles = state.pop(CYCLES_KEY, None)
+    if last_cycles is not None:
+        last_cycles = [ int(x) for x in last_cycles.split() ]
+
+    to_delete = process_backups(backup_list, state, options.cycles, last_cycles)
 
     if len(backup_list) and (len(to_delete)/len(backup_list) > options.proportion_delete):
         raise QuietError('Would remove more than %d%% of backups, aborting' % (options.proportion_delete*100))
@@ -130,6 +143,7 @@ def main(args=None):
         log.info('Dry run, not saving state.')
     else:
         log.info('Saving state..')
+        state[CYCLES_KEY] = ' '.join('%d' % x for x in options.cycles)
         with open(options.state + '.new', 'wb') as fh:
             fh.write(freeze_basic_mapping(state))
         if os.path.exists(options.state):
@@ -142,34 +156,51 @@ def upgrade_to_state(backup_list):
     now = datetime.now()
     age = dict()
     for x in sorted(backup_list):
-        age[x] = now - datetime.strptime(x, '%Y-%m-%d_%H:%M:%S')
+        age[x] = now - parse_backup_name(x)
         log.info('Backup %s is %s hours old', x, age[x])
 
-    deltas = [ abs(x - y) for x in age.values()
-                          for y in age.values() if x != y ]
-    step = min(deltas)
+    # The smallest difference between any two ages is always the
+    # difference between two neighbours in sorted order
+    sorted_ages = sorted(age.values())
+    step = min(b - a for (a, b) in zip(sorted_ages, sorted_ages[1:]))
     log.info('Assuming backup interval of %s hours', step)
 
     state = dict()
     for x in sorted(age):
-        state[x] = 0
-        while age[x] > timedelta(0):
-            state[x] += 1
-            age[x] -= step
+        # Number of steps needed to bring age down to zero (or below)
+        state[x] = max(0, -(-age[x] // step))
         log.info('Backup %s is %d cycles old', x, state[x])
 
     log.info('State construction complete.')
     return state
 
-def process_backups(backup_list, state, cycles):
+def parse_backup_name(name):
+    '''Return creation time of backup *name*
+
+    *name* must match `BACKUP_RE`. This is equivalent to (but much faster
+    than) ``datetime.strptime(name, '%Y-%m-%d_%H:%M:%S')``.
+    '''
+
+    return datetime(int(name[0:4]), int(name[5:7]), int(name[8:10]),
+                    int(name[11:13]), int(name[14:16]), int(name[17:19]))
 
-    # New backups
+def process_backups(backup_list, state, cycles, last_cycles=None):
+    '''Determine backups that are no longer needed
+
+    *state* maps backup names to their age in cycles, and is updated in
+    place. *last_cycles* are the age range boundaries that were used when
+    *state* was last processed (if known). Returns the set of backups that
+    should be deleted.
+    '''
+
+    # New backups (every new backup ages all older ones by one cycle)
     new_backups = backup_list - set(state)
-    for x in sorted(new_backups):
-        log.info('Found new backup %s', x)
-        for y in state:
-            state[y] += 1
-        state[x] = 0
+    if new_backups:
+        for x in state:
+            state[x] += len(new_backups)
+        for (i, x) in enumerate(sorted(new_backups), start=1):
+            log.info('Found new backup %s', x)
+            state[x] = len(new_backups) - i
 
     for x in state:
         log.debug('Backup %s has age %d', x, state[x])
@@ -180,63 +211,45 @@ def process_backups(backup_list, state, cycles):
         log.warning('backup %s is missing. Did you delete it manually?', x)
         del state[x]
 
+    # If the same backups have already been processed with the same age
+    # ranges, every one of them was kept for some range - so running the
+    # simulation again would keep all of them too.
+    if not new_backups and not missing_backups and cycles == last_cycles:
+        log.info('No new or missing backups and age ranges unchanged, '
+                 'nothing to do.')
+        return set()
+
     # Ranges
     ranges = [ (0, cycles[0]) ]
     for i in range(1, len(cycles)):
         ranges.append((cycles[i - 1], cycles[i]))
 
+    # Names and current ages of existing backups, as parallel lists in the
+    # order of *state*.
+    state_keys = list(state)
+    state_ages = [ state[x] for x in state_keys ]
+
     # Go forward in time to see what backups need to be kept
-    simstate = dict()
     keep = set()
     missing = defaultdict(list)
-    for step in range(max(cycles)):
-
-        log.debug('Considering situation after %d more backups', step)
-        for x in simstate:
-            simstate[x] += 1
-            log.debug('Backup x now has simulated age %d', simstate[x])
-
-        # Add the hypothetical backup that has been made "just now"
-        if step != 0:
-            simstate[step] = 0
-
-        for (min_, max_) in ranges:
-            log.debug('Looking for backup for age range %d to %d', min_, max_)
-
-            # Look in simstate
-            found = False
-            for (backup, age) in simstate.items():
-                if min_ <= age < max_:
-                    found = True
-                    break
-            if found:
-                # backup and age will be defined
-                #pylint: disable=W0631
-                log.debug('Using backup %s (age %d)', backup, age)
-                continue
-
-            # Look in state
-            for (backup, age) in state.items():
-                age += step
-                if min_ <= age < max_:
-                    log.info('Keeping backup %s (current age %d) for age range %d to %d%s',
-                             backup, state[backup], min_, max_,
-                             (' in %d cycles' % step) if step else '')
-                    simstate[backup] = age
-                    keep.add(backup)
-                    break
+    for (step, i, idx) in simulate(state_ages, cycles):
+        (min_, max_) = ranges[i]
+        if idx is not None:
+            backup = state_keys[idx]
+            log.info('Keeping backup %s (current age %d) for age range %d to %d%s',
+                     backup, state_ages[idx], min_, max_,
+                     (' in %d cycles' % step) if step else '')
+            keep.add(backup)
+        elif step == 0:
+            log.info('Note: there is currently no backup available '
+                     'for age range %d to %d', min_, max_)
+        else:
+            missing[(min_, max_)].append(step)
 
-            else:
-                if step == 0:
-                    log.info('Note: there is currently no backup available '
-                             'for age range %d to %d', min_, max_)
-                else:
-                    missing['%d to %d' % (min_, max_)].append(step)
-
-    for range_ in sorted(missing):
-        log.info('Note: there will be no backup for age range %s '
+    for (min_, max_) in sorted(missing):
+        log.info('Note: there will be no backup for age range %d to %d '
                  'in (forthcoming) cycle(s): %s',
-                 range_, format_list(missing[range_]))
+                 min_, max_, format_list(missing[(min_, max_)]))
 
     to_delete = set(state) - keep
     for x in to_delete:
@@ -245,6 +258,76 @@ def process_backups(backup_list, state, cycles):
     return to_delete
 
 
+def simulate(ages, cycles):
+    '''Simulate the next `max(cycles)` backup cycles
+
+    *ages* is a list with the current ages of the existing backups, and
+    *cycles* is the list of age range boundaries (so that range *i* is
+    ``[cycles[i-1], cycles[i])``, with ``cycles[-1]`` taken as zero).
+
+    In every step, a new (hypothetical) backup is made. Whenever there is no
+    kept or hypothetical backup for an age range, the first existing backup
+    that falls into the range is kept.
+
+    Returns a list of ``(step, range, idx)`` tuples, one for every step and
+    range that could not be covered with already kept or hypothetical
+    backups. *idx* is the index (in *ages*) of the backup that is kept from
+    then on, or `None` if there is no suitable backup.
+
+    This function deliberately works only with integers and does no logging,
+    so that the inner loops stay as tight as possible.
+    '''
+
+    # Rather than going through every step, we make use of the following:
+    #
+    # - At step t, the hypothetical backups have ages 0 to t-1. A non-empty
+    #   range [min_, max_) is therefore always covered after step min_.
+    #
+    # - A backup with age a (at step 0) is in the range for steps
+    #   min_ - a to max_ - a - 1. Once it has been kept, we can skip directly
+    #   to the step at which it leaves the range again.
+    #
+    # - Whether a range is covered at step t only depends on backups that
+    #   have been kept for the same or a lower range (a backup kept for a
+    #   higher range is already too old, and a backup kept for a lower range
+    #   at a later step is still too young). Ranges can thus be handled one
+    #   after the other.
+    #
+    # Kept backups are stored as a sorted list of their ages at step 0, and
+    # existing backups as (age, index) tuples sorted by age, so that the
+    # backups in a given age window can be found by bisection.
+    by_age = sorted((age, idx) for (idx, age) in enumerate(ages))
+    kept = []
+    res = []
+    for (i, (min_, max_)) in enumerate(zip([0] + cycles, cycles)):
+        if min_ == max_:
+            # Empty range, can never be covered
+            res.extend((step, i, None) for step in range(max(cycles)))
+            continue
+
+        step = 0
+        while step <= min_:
+            # Look at kept backups
+            j = bisect_left(kept, min_ - step)
+            if j < len(kept) and kept[j] + step < max_:
+                step = max_ - kept[j]
+                continue
+
+            # Look at existing backups
+            lo = bisect_left(by_age, (min_ - step,))
+            hi = bisect_left(by_age, (max_ - step,))
+            if lo < hi:
+                idx = min(idx for (_, idx) in by_age[lo:hi])
+                insort(kept, ages[idx])
+                res.append((step, i, idx))
+            else:
+                res.append((step, i, None))
+                step += 1
+
+    res.sort()
+    return res
+
+
 def format_list(l):
     if not l:
         return ''
@@ -14,8 +14,10 @@ from .common import (AbstractBackend, DanglingStorageURLError, NoSuchObject,
 from ..common import ThawError, freeze_basic_mapping, thaw_basic_mapping
 import _thread
 import struct
+import errno
 import io
 import os
+import re
 import shutil
 
 log = logging.getLogger(__name__)
@@ -211,7 +213,7 @@ class Backend(AbstractBackend, metaclass=ABCDocstMeta):
                 dest.write(b's3ql_1\n')
                 dest.write(struct.pack('<H', len(buf)))
                 dest.write(buf)
-            shutil.copyfileobj(src, dest, BUFSIZE)
+            _copy_data(src, dest.fh)
         except:
             if dest:
                 os.unlink(tmpname)
@@ -234,13 +236,12 @@ class Backend(AbstractBackend, metaclass=ABCDocstMeta):
         if not key.startswith('s3ql_data_'):
             return os.path.join(self.prefix, key)
 
+        # Every three characters of the object number add another level of
+        # directories (the on-disk layout depends on this, so the depth
+        # must not be changed).
         no = key[10:]
-        path = [ self.prefix, 's3ql_data_']
-        for i in range(0, len(no), 3):
-            path.append(no[:i])
-        path.append(key)
-
-        return os.path.join(*path)
+        return os.path.join(self.prefix, 's3ql_data_',
+                            *[ no[:i] for i in range(3, len(no), 3) ], key)
 
 def _read_meta(fh):
     buf = fh.read(9)
@@ -253,23 +254,45 @@ def _read_meta(fh):
     except ThawError:
         raise CorruptedObjectError('Invalid metadata')
 
+def _copy_data(src, dest):
+    '''Copy remaining contents of *src* to *dest*
+
+    *src* and *dest* must be file objects that are backed by regular
+    files. Where possible, the data is copied by the kernel (using
+    `os.sendfile`) instead of being passed through Python buffers.
+    '''
+
+    # src may be buffered, so its file descriptor may be positioned
+    # beyond the logical read position.
+    offset = src.tell()
+    try:
+        sent = os.sendfile(dest.fileno(), src.fileno(), offset, 1 << 30)
+    except (AttributeError, OSError) as exc:
+        # Not all platforms support sendfile() between regular files
+        if isinstance(exc, OSError) and exc.errno not in (
+                errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+            raise
+        shutil.copyfileobj(src, dest, BUFSIZE)
+        return
+
+    while sent:
+        offset += sent
+        sent = os.sendfile(dest.fileno(), src.fileno(), offset, 1 << 30)
+
+_ESCAPE_MAP = { '=': '=3D', '/': '=2F', '#': '=23' }
+_ESCAPE_RE = re.compile('[=/#]')
+_UNESCAPE_MAP = { v: k for (k, v) in _ESCAPE_MAP.items() }
+_UNESCAPE_RE = re.compile('=(?:3D|2F|23)')
+
 def escape(s):
     '''Escape '/', '=' and '.' in s'''
 
-    s = s.replace('=', '=3D')
-    s = s.replace('/', '=2F')
-    s = s.replace('#', '=23')
-
-    return s
+    return _ESCAPE_RE.sub(lambda m: _ESCAPE_MAP[m.group()], s)
 
 def unescape(s):
     '''Un-Escape '/', '=' and '.' in s'''
 
-    s = s.replace('=2F', '/')
-    s = s.replace('=23', '#')
-    s = s.replace('=3D', '=')
-
-    return s
+    return _UNESCAPE_RE.sub(lambda m: _UNESCAPE_MAP[m.group()], s)
 
 
 # Inherit from io.FileIO rather than io.BufferedReader to disable buffering. Default buffer size is